@@ -2,14 +2,21 @@
 
 from math import sqrt, copysign
 import csv
+import multiprocessing
 import os
+import resource
+import sys
+import time
+from functools import partial
 from os.path import (splitext, join)
 import re
+import numpy as np
 import nibabel as ni
 from nipype.interfaces.base import CommandLine
 import nipype.interfaces.fsl as fsl
 from nipype.utils.filemanip import split_filename
 import argparse
+from Queue import Empty
 from datetime import datetime
 from tempfile import mkdtemp
 
@@ -93,7 +100,7 @@ class CenterMass():
         ##!! note of other package used
         com = self.find_center_of_mass()
         if com is None:
-            return (('na', 'na', 'na'), 'na', 'FAILED with errorcode ' + output.runtime.returncode)
+            return (('na', 'na', 'na'), 'na', '!center of mass failed')
         self.cm = com
         return_val = (tuple(self.cm), 
                       self._calc_dist(self.cm)[0],
@@ -102,16 +109,146 @@ class CenterMass():
         return return_val 
 
 
+class QCStats(CenterMass):
+
+    stat_names = ('count', 'min', 'max', 'mean', 'sum', 'bbox')
+
+    def __init__(self, filename, use_mm = True, thresh = 20, stats = None,
+                 lower = None, mask = None):
+        """ Calculate center of mass and QC statistics of an image volume
+        from a single read of the file, using numpy instead of fslstats
+
+        Parameters
+        ----------
+        filename : str
+            Str representing image file
+        use_mm : Bool
+            Calc center of mass in mm space (default True)
+            If False calculates center of mass in voxel space
+        thresh : int
+            Threshold for distance from 0,0,0 to center of mass
+        stats : list of str
+            Statistics to compute, any of QCStats.stat_names
+            (default all)
+        lower : float
+            Only voxels with intensity above lower are used
+            (like fslstats -l), default uses all non-zero voxels
+        mask : str
+            Image file, only voxels non-zero in mask are used
+            (like fslstats -k)
+
+        Statistics are computed over the selected voxels
+        count : number of selected voxels
+        min, max, mean, sum : intensity of selected voxels
+        bbox : (xmin, xmax, ymin, ymax, zmin, zmax) voxel bounding box
+            of selected voxels
+
+        After run(), statistics are in self.stats, 'na' if no voxels
+        were selected. 4D images are reduced over all frames.
+        """
+        CenterMass.__init__(self, filename, use_mm, thresh)
+        self.use_mm = use_mm
+        if stats is None:
+            stats = self.stat_names
+        for stat in stats:
+            if stat not in self.stat_names:
+                raise ValueError('unknown statistic: %s'%stat)
+        self.stat_list = list(stats)
+        self.lower = lower
+        self.mask = mask
+        self.stats = {}
+
+    def _select(self, data):
+        """ returns boolean array of voxels to include"""
+        if self.lower is None:
+            selected = data != 0
+        else:
+            selected = data > self.lower
+        if data.dtype.kind in 'fc':
+            # like fslstats, ignore nan and inf voxels
+            selected &= np.isfinite(data)
+        if self.mask is not None:
+            maskdat = np.asarray(ni.load(self.mask).get_data())
+            maskdat = maskdat.reshape(maskdat.shape[:3] +
+                                      (1,) * (data.ndim - 3))
+            selected = np.logical_and(selected, maskdat != 0)
+        return selected
+
+    def find_center_of_mass(self):
+        """ loads image once, calculates center of mass and the
+        requested statistics, stores statistics in self.stats
+
+        Reductions work on the boolean selection and the selected
+        intensities (same dtype as the data), so no per-voxel index
+        or float64 copies are made
+
+        Returns
+        -------
+        center_of_mass : list of floats, None if no voxels selected
+            or the image can not be read
+        """
+        self.stats = dict([(stat, 'na') for stat in self.stat_list])
+        try:
+            img = ni.load(self.filename)
+            data = np.asarray(img.get_data())
+            selected = self._select(data)
+        except Exception as e:
+            print self.filename + ' could not be read: ' + str(e)
+            return None
+        count = np.count_nonzero(selected)
+        if 'count' in self.stats:
+            self.stats['count'] = count
+        if count == 0:
+            return None
+        others = [tuple([a for a in range(data.ndim) if a != k])
+                  for k in range(3)]
+        # marginal sums of the selected intensities along x, y, z
+        weighted = np.where(selected, data, 0)
+        marginals = [weighted.sum(axis = others[k], dtype = np.float64)
+                     for k in range(3)]
+        del weighted
+        total = marginals[0].sum()
+        if 'mean' in self.stats:
+            self.stats['mean'] = total / count
+        if 'sum' in self.stats:
+            self.stats['sum'] = total
+        if 'min' in self.stats or 'max' in self.stats:
+            values = np.ma.masked_array(data, mask = ~selected)
+            if 'min' in self.stats:
+                self.stats['min'] = values.min()
+            if 'max' in self.stats:
+                self.stats['max'] = values.max()
+            del values
+        if 'bbox' in self.stats:
+            bbox = []
+            for k in range(3):
+                present = np.nonzero(np.any(selected, axis = others[k]))[0]
+                bbox.extend([int(present[0]), int(present[-1])])
+            self.stats['bbox'] = tuple(bbox)
+        if total == 0:
+            return None
+        com = [np.dot(np.arange(len(marginals[k])), marginals[k]) / total
+               for k in range(3)]
+        if self.use_mm:
+            com = list(np.dot(img.get_affine(), com + [1.])[:3])
+        return [float(x) for x in com]
+
+
 class CSVIO:
 
-    def __init__(self, filename, mode = 'w'):
+    header = ['path','id', 'x', 'y', 'z', 'distance', 'warning flags']
+
+    def __init__(self, filename, mode = 'w', extra_fields = None):
         """
         Modes:
         'w' = (over)write
         'a' = append
         'r' = read
+
+        extra_fields are appended to the header in write mode
         """
         self.mode = mode
+        self.fields = self.header + list(extra_fields or [])
         filename = os.path.abspath(filename)
         if not re.search('.csv', filename):
             filename = filename + '.csv'
@@ -140,7 +277,7 @@ class CSVIO:
             self.reader.next()
             self.initialized = True
             return
-        self.writer.writerow(['path','id', 'x', 'y', 'z', 'distance', 'warning flags'])
+        self.writer.writerow(self.fields)
         self.initialized = True
 
     def writeline(self, output):
@@ -226,13 +363,19 @@ class CMTransform:
         newimg.to_filename(new_file)
         return new_file
 
-    def fix_batch(self, file_list):
+    def fix_batch(self, file_list, scheduler = None):
         """
         Calculates center of mass for self.img, applies new affine to all
         .nii files in file_list
+        If scheduler (a MemoryScheduler) is given, files are processed
+        in parallel under its memory budget
         Returns list of output files
         """
         new_affine = self.cmtransform()
+        if scheduler is not None:
+            # apply_affine holds the data and a copy written to file
+            return scheduler.run(apply_affine, file_list, (new_affine,),
+                                 partial(estimate_memory, factor = 2))
         outlist = []
         for infile in file_list:
             outlist.append(apply_affine(infile, new_affine))
@@ -242,7 +385,7 @@ class CMTransform:
 class CMAnalyze:
    
     def __init__(self, outputfile, mode='w', use_mm = True, threshold = 20,\
-                 overwrite = True):
+                 overwrite = True, stats = None, lower = None, mask = None):
         """
         Checks a .nii file for center of mass, and writes output to
         a .csv file.
@@ -259,19 +402,43 @@ class CMAnalyze:
             specified by use_mm
         overwrite : Bool
             if overwrite is True, will overwrite all data in outputfile
-
-
+        stats : list of str
+            QC statistics (see QCStats.stat_names) to write as extra
+            columns, computed with the center of mass in one read
+            of the file. Default None uses fslstats for center of mass only
+        lower : float
+            intensity threshold for QCStats center of mass and statistics
+        mask : str
+            mask image for QCStats center of mass and statistics
+
+        stats can not be used with mode 'a', as the header of an
+        existing log may lack the statistics columns
         """
+        if stats and mode == 'a':
+            raise ValueError('stats can not be appended to an existing log')
+        for stat in stats or []:
+            if stat not in QCStats.stat_names:
+                raise ValueError('unknown statistic: %s'%stat)
         self.donotrun = False
         self.threshold = threshold
         self.use_mm = use_mm
         self.overwrite = overwrite
+        self.stats = stats
+        self.lower = lower
+        self.mask = mask
+        self.stat_fields = []
+        for stat in stats or []:
+            if stat == 'bbox':
+                self.stat_fields.extend(['bbox_' + ax + lim for ax in 'xyz'
+                                         for lim in ('min', 'max')])
+            else:
+                self.stat_fields.append(stat)
         if os.path.exists(outputfile) and not self.overwrite:
             print 'Need permission to overwrite: ' + outputfile +\
                   ', please run without --no-overwrite option'
             self.donotrun = True
             return
-        self.writer = CSVIO(outputfile, mode) 
+        self.writer = CSVIO(outputfile, mode, self.stat_fields)
 
     def close(self):
         self.writer.close()
@@ -279,28 +446,37 @@ class CMAnalyze:
     def flags(self, infile):
         if self.donotrun:
             return True
+        arg = self.check(infile)
+        if arg is not None:
+            self.flag(arg, infile)
+            return True
+
+    def check(self, infile):
+        """ returns the flag for an invalid infile, None if valid"""
         if not os.path.exists(infile):
             print infile + ' does not exist!'
-            self.flag('path', infile)
-            return True
+            return 'path'
         if not re.search('B[0-9]{2}-[0-9]{3}', infile):
             print infile + ' not in valid directory'
-            self.flag('dir', infile)
-            return True
+            return 'dir'
         dir, infilename = os.path.split(infile)
         if '.nii' not in infilename:
             print infile + ' is not a valid nifti infile'
-            self.flag('filename', infile)
-            return True
+            return 'filename'
 
     def flag(self, arg, infile):
+        self.writer.writeline(self.flagline(arg, infile))
+
+    def flagline(self, arg, infile):
         d = {'path': [infile, 'na', 'na', 'na', 'na', 'na',
                       '!path does not exist'],
              'dir': [infile, 'na', 'na', 'na', 'na', 'na',
                      '!infile not in a valid directory'],
-             'infile': [infile, 'na', 'na', 'na', 'na', 'na',
-                      '!invalid infiletype']}
-        self.writer.writeline(d[arg])
+             'filename': [infile, 'na', 'na', 'na', 'na', 'na',
+                      '!invalid infiletype'],
+             'job': [infile, 'na', 'na', 'na', 'na', 'na',
+                     '!analysis failed']}
+        return d[arg] + ['na'] * len(self.stat_fields)
 
     def run(self, filename):
         """
@@ -311,22 +487,230 @@ class CMAnalyze:
         filename = os.path.abspath(filename)
         if self.flags(filename):
             return
+        newline = self.analyze(filename)
+        self.writer.writeline(newline)
+        return newline
 
+    def analyze(self, filename):
+        """
+        Calculates the center of mass (and statistics) of a file
+        that passed flags(), returns the output line without writing it
+        """
         idsearch = re.search('B[0-9]{2}-[0-9]{3}', filename)
         id = idsearch.group()
-        cm = CenterMass(filename, self.use_mm, self.threshold)
+        if self.stats is None:
+            cm = CenterMass(filename, self.use_mm, self.threshold)
+        else:
+            cm = QCStats(filename, self.use_mm, self.threshold, self.stats,
+                         self.lower, self.mask)
         (x, y, z), dist, flags = cm.run()
         newline = [filename, id, x, y, z, dist, flags]
-        self.writer.writeline(newline)
+        for stat in self.stats or []:
+            value = cm.stats[stat]
+            if stat == 'bbox':
+                if value == 'na':
+                    value = ['na'] * 6
+                newline.extend(value)
+            else:
+                newline.append(value)
         return newline
 
-    def run_list(self, filelst):
+    def estimate(self, filename):
+        """
+        Estimates peak memory (bytes) of analyze() on filename
+        fslstats converts the image to float32, QCStats holds
+        the data, a selection copy and boolean masks
+        """
+        if self.stats is None:
+            return estimate_memory(filename, voxel_bytes = 4)
+        estimate = estimate_memory(filename, factor = 2, voxel_bytes = 3)
+        if self.mask is not None:
+            estimate += estimate_memory(self.mask, voxel_bytes = 2)
+        return estimate
+
+    def run_list(self, filelst, scheduler = None):
         """
         Reads a file containing a list of paths to .nii files
         and runs run() on each
+        If scheduler (a MemoryScheduler) is given, files are analyzed
+        in parallel under its memory budget, and all lines (including
+        flagged files) are written in input order
+        """
+        if scheduler is None:
+            for infile in filelst:
+                self.run(infile)
+            return
+        if self.donotrun:
+            return
+        filelst = [os.path.abspath(infile) for infile in filelst]
+        lines = [None] * len(filelst)
+        valid = []
+        for k, infile in enumerate(filelst):
+            arg = self.check(infile)
+            if arg is None:
+                valid.append(k)
+            else:
+                lines[k] = self.flagline(arg, infile)
+        results = scheduler.run(self.analyze, [filelst[k] for k in valid],
+                                estimator = self.estimate)
+        for k, newline in zip(valid, results):
+            if newline is None:
+                newline = self.flagline('job', filelst[k])
+            lines[k] = newline
+        for line in lines:
+            self.writer.writeline(line)
+
+
+def estimate_memory(filename, factor = 1, voxel_bytes = 0):
+    """
+    Estimates memory (bytes) of the decoded image data of filename
+    from its header (shape, dtype), without reading the data
+    Scaled images are decoded as float64
+    Returns factor * decoded size + voxel_bytes per voxel,
+    0 if the header can not be read
+    """
+    try:
+        img = ni.load(filename)
+    except Exception:
+        return 0
+    hdr = img.get_header()
+    itemsize = np.dtype(hdr.get_data_dtype()).itemsize
+    # nibabel moves the scaling from the header to the data proxy
+    slope = getattr(img.dataobj, 'slope', 1)
+    inter = getattr(img.dataobj, 'inter', 0)
+    if slope != 1 or inter != 0:
+        itemsize = 8
+    nvox = 1
+    for dim in hdr.get_data_shape():
+        nvox *= dim
+    return int(nvox * (factor * itemsize + voxel_bytes))
+
+
+def _peak_memory():
+    """ returns peak resident memory (bytes) of the current process
+    or of its largest finished child (e.g. fslstats)"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def _scheduled_job(queue, index, func, infile, args):
+    """ runs func(infile, *args) in a worker process, puts
+    (index, result, error, peak memory) on queue"""
+    try:
+        result = func(infile, *args)
+        error = None
+    except Exception as e:
+        result = None
+        error = str(e)
+    queue.put((index, result, error, _peak_memory()))
+
+
+class MemoryScheduler:
+
+    def __init__(self, max_memory = None, ncores = None, factor = 3):
+        """
+        Runs one job per file in parallel worker processes, admitting
+        jobs while their estimated memory fits in max_memory and
+        fewer than ncores are running. Largest jobs are started first.
+
+        Parameters
+        ----------
+        max_memory : int
+            memory budget in bytes (default 80% of physical memory)
+        ncores : int
+            maximum number of concurrent jobs (default number of cpus)
+        factor : float
+            multiplier on the decoded image size (estimate_memory)
+            to account for working copies made by a job, used when
+            run() is not given an estimator
+
+        A job larger than max_memory is run alone.
+        After run(), self.report holds (file, estimated, peak) per job,
+        in bytes, where peak is the observed peak resident memory
+        of the worker process or of the largest tool it ran. The worker
+        is forked, so its peak includes pages shared with the parent.
+        """
+        if max_memory is None:
+            max_memory = int(0.8 * os.sysconf('SC_PAGE_SIZE') *
+                             os.sysconf('SC_PHYS_PAGES'))
+        if ncores is None:
+            ncores = multiprocessing.cpu_count()
+        self.max_memory = max_memory
+        self.ncores = ncores
+        self.factor = factor
+        self.grace = 5
+        self.report = []
+
+    def estimate(self, filename):
+        """ returns estimated memory (bytes) of a job on filename"""
+        return int(self.factor * estimate_memory(filename))
+
+    def run(self, func, file_list, args = (), estimator = None):
+        """
+        Runs func(infile, *args) for each infile in file_list
+        estimator(infile) returns the memory (bytes) of a job,
+        default self.estimate
+        Returns list of results in order of file_list,
+        None for jobs that failed
         """
-        for infile in filelst:
-            self.run(infile)
+        if estimator is None:
+            estimator = self.estimate
+        estimates = [int(estimator(infile)) for infile in file_list]
+        pending = sorted(range(len(file_list)),
+                         key = lambda k: estimates[k], reverse = True)
+        results = [None] * len(file_list)
+        peaks = [None] * len(file_list)
+        running = {}
+        exited = {}
+        used = 0
+        queue = multiprocessing.Queue()
+        while pending or running:
+            admitted = True
+            while pending and admitted and len(running) < self.ncores:
+                admitted = False
+                for k in pending:
+                    if not running or used + estimates[k] <= self.max_memory:
+                        proc = multiprocessing.Process(target = _scheduled_job,
+                                   args = (queue, k, func, file_list[k], args))
+                        proc.start()
+                        running[k] = proc
+                        used += estimates[k]
+                        pending.remove(k)
+                        admitted = True
+                        break
+            try:
+                index, result, error, peak = queue.get(timeout = 1)
+            except Empty:
+                # a worker killed (e.g. out of memory), or whose result
+                # could not be sent, exits without reporting
+                now = time.time()
+                for k, proc in running.items():
+                    if proc.exitcode is not None and k not in exited:
+                        exited[k] = now
+                lost = [k for k in exited if now - exited[k] > self.grace]
+                if not lost:
+                    continue
+                try:
+                    index, result, error, peak = queue.get_nowait()
+                except Empty:
+                    index = lost[0]
+                    result, peak = None, None
+                    error = 'exited without result, exit code %d'%\
+                            running[index].exitcode
+            exited.pop(index, None)
+            running.pop(index).join()
+            used -= estimates[index]
+            if error is not None:
+                print file_list[index] + ' failed: ' + error
+            results[index] = result
+            peaks[index] = peak
+            print '%s: estimated %d, peak %s bytes'%(file_list[index],
+                                                     estimates[index], peak)
+        self.report = zip(file_list, estimates, peaks)
+        return results
 
 def apply_affine(infile, affine):
     """
@@ -14,8 +14,9 @@ from numpy.testing import (assert_raises, assert_equal,
                            assert_almost_equal)
 
 import nicm
-from ..nicm import (CenterMass, CSVIO,
-                     CMTransform, CMAnalyze, apply_affine)
+from ..nicm import (CenterMass, QCStats, CSVIO,
+                     CMTransform, CMAnalyze, apply_affine,
+                     MemoryScheduler, estimate_memory)
 
 
 data_path = abspath(join(dirname(__file__), 'data'))
@@ -63,6 +64,81 @@ class TestCenterMass(TestCase):
                             decimal = 2)
         
 
+class TestQCStats(TestCase):
+    testnii = join(data_path, 'B00-100', 'test.nii')
+
+    def test_interface(self):
+        qc = QCStats(self.testnii, stats = ['count', 'bbox'], lower = 0.5)
+        assert_equal(qc.stat_list, ['count', 'bbox'])
+        assert_equal(qc.lower, 0.5)
+        assert_raises(ValueError, QCStats, self.testnii, stats = ['median'])
+
+    def test_find_center_of_mass(self):
+        center_of_mass = QCStats(self.testnii).find_center_of_mass()
+        assert_almost_equal(center_of_mass, [10.5, 4.0, 13.0])
+        center_of_mass = QCStats(self.testnii, use_mm = False)\
+                         .find_center_of_mass()
+        assert_almost_equal(center_of_mass, [10.5, 4.0, 6.5])
+
+    def test_stats(self):
+        qc = QCStats(self.testnii)
+        center_of_mass = qc.run()
+        assert_almost_equal(center_of_mass[1], 17.1828, decimal=4)
+        assert_equal(qc.stats['count'], 40)
+        assert_equal(qc.stats['min'], 1.0)
+        assert_equal(qc.stats['max'], 1.0)
+        assert_equal(qc.stats['mean'], 1.0)
+        assert_equal(qc.stats['sum'], 40.0)
+        assert_equal(qc.stats['bbox'], (9, 12, 2, 6, 6, 7))
+
+    def test_4d(self):
+        # frames are reduced together, center of mass is spatial
+        img = ni.load(self.testnii)
+        data = np.asarray(img.get_data())
+        data4d = np.concatenate([data[..., None], 3 * data[..., None]], 3)
+        tmpfile = join(data_path, 'test4d.nii')
+        ni.Nifti1Image(data4d, img.get_affine()).to_filename(tmpfile)
+        qc = QCStats(tmpfile, lower = 0.5)
+        try:
+            center_of_mass = qc.find_center_of_mass()
+        finally:
+            os.remove(tmpfile)
+        assert_almost_equal(center_of_mass, [10.5, 4.0, 13.0])
+        assert_equal(qc.stats['count'], 80)
+        assert_equal(qc.stats['max'], 3.0)
+        assert_equal(qc.stats['sum'], 160.0)
+        assert_equal(qc.stats['bbox'], (9, 12, 2, 6, 6, 7))
+
+    def test_nan(self):
+        img = ni.load(self.testnii)
+        data = np.asarray(img.get_data(), dtype = np.float32)
+        data[0, 0, 0] = np.nan
+        tmpfile = join(data_path, 'testnan.nii')
+        ni.Nifti1Image(data, img.get_affine()).to_filename(tmpfile)
+        qc = QCStats(tmpfile)
+        try:
+            center_of_mass = qc.find_center_of_mass()
+        finally:
+            os.remove(tmpfile)
+        assert_almost_equal(center_of_mass, [10.5, 4.0, 13.0])
+        assert_equal(qc.stats['count'], 40)
+        assert_equal(qc.stats['sum'], 40.0)
+        assert_equal(qc.stats['max'], 1.0)
+
+    def test_unreadable(self):
+        qc = QCStats(join(data_path, 'notaniftifile.txt'),
+                     stats = ['count', 'bbox'])
+        assert_equal(qc.run(), (('na', 'na', 'na'), 'na',
+                                '!center of mass failed'))
+        assert_equal(qc.stats, {'count': 'na', 'bbox': 'na'})
+
+    def test_empty(self):
+        qc = QCStats(self.testnii, stats = ['count', 'mean'], lower = 10)
+        assert_equal(qc.run(), (('na', 'na', 'na'), 'na',
+                                '!center of mass failed'))
+        assert_equal(qc.stats, {'count': 0, 'mean': 'na'})
+
+
 class TestCSVIO(TestCase):
     outfile = join(data_path, 'test.csv')
     line = ['kitty', 'hawk', 'princess', 'butterfly']
@@ -114,6 +190,109 @@ class TestCMAnalyze(TestCase):
         reader = CSVIO(self.outfile, 'r')
         assert_equal(reader.readline(), self.line) 
 
+    def test_append_stats(self):
+        assert_raises(ValueError, CMAnalyze, self.outfile, 'a',
+                      stats = ['count'])
+
+    def test_run_list_unreadable(self):
+        badfile = join(data_path, 'B00-100', 'bad.nii')
+        with open(badfile, 'w') as f:
+            f.write('not a nifti file')
+        analyze = CMAnalyze(self.outfile, stats = ['count'])
+        try:
+            analyze.run_list([badfile, self.infile])
+        finally:
+            analyze.close()
+            os.remove(badfile)
+        reader = CSVIO(self.outfile, 'r')
+        assert_equal(reader.readline(), [badfile, 'B00-100', 'na', 'na', 'na',
+                     'na', '!center of mass failed', 'na'])
+        assert_equal(reader.readline(), self.line + ['40'])
+
+    def test_unknown_stats(self):
+        assert_raises(ValueError, CMAnalyze, self.outfile,
+                      stats = ['median'])
+
+    def test_run_stats(self):
+        analyze = CMAnalyze(self.outfile, stats = ['count', 'bbox'])
+        analyze.run(self.infile)
+        analyze.close()
+        reader = CSVIO(self.outfile, 'r')
+        assert_equal(reader.readline(), self.line +
+                     ['40', '9', '12', '2', '6', '6', '7'])
+
+    def test_run_list_scheduler(self):
+        analyze = CMAnalyze(self.outfile, stats = ['count'])
+        scheduler = MemoryScheduler(ncores = 2)
+        analyze.run_list([self.infile, 'nicm_test/notafile.nii'], scheduler)
+        analyze.close()
+        reader = CSVIO(self.outfile, 'r')
+        assert_equal(reader.readline(), self.line + ['40'])
+        assert_equal(reader.readline()[6], '!path does not exist')
+
+
+class TestMemoryScheduler(TestCase):
+    infile = join(data_path, 'B00-100', 'test.nii')
+    infile2 = join(data_path, 'B00-100', 'test2.nii')
+
+    def test_estimate_memory(self):
+        img = ni.load(self.infile)
+        nbytes = np.prod(img.get_shape()) * img.get_data_dtype().itemsize
+        assert_equal(estimate_memory(self.infile), nbytes)
+        assert_equal(estimate_memory(join(data_path, 'notaniftifile.txt')), 0)
+        scheduler = MemoryScheduler(factor = 2)
+        assert_equal(scheduler.estimate(self.infile), 2 * nbytes)
+        nvox = np.prod(img.get_shape())
+        assert_equal(estimate_memory(self.infile, 2, 3),
+                     2 * nbytes + 3 * nvox)
+        # scaled int16 decodes to float64
+        data = np.asarray(img.get_data(), dtype = np.int16)
+        scaled = ni.Nifti1Image(data, img.get_affine())
+        scaled.header.set_slope_inter(2.0, 1.0)
+        tmpfile = join(data_path, 'testscaled.nii')
+        scaled.to_filename(tmpfile)
+        try:
+            estimated = estimate_memory(tmpfile)
+            decoded = ni.load(tmpfile).get_data().nbytes
+        finally:
+            os.remove(tmpfile)
+        assert_equal(estimated, 8 * nvox)
+        assert_equal(estimated, decoded)
+
+    def test_run(self):
+        # budget fits one job at a time, jobs still all run
+        budget = estimate_memory(self.infile)
+        scheduler = MemoryScheduler(max_memory = budget, ncores = 2,
+                                    factor = 1)
+        results = scheduler.run(os.path.basename,
+                                [self.infile, self.infile2, self.infile])
+        assert_equal(results, ['test.nii', 'test2.nii', 'test.nii'])
+        assert_equal([r[0] for r in scheduler.report],
+                     [self.infile, self.infile2, self.infile])
+        for infile, estimated, peak in scheduler.report:
+            assert_equal(estimated, budget)
+            assert_equal(peak > 0, True)
+
+    def test_estimator(self):
+        scheduler = MemoryScheduler(ncores = 1)
+        scheduler.run(os.path.basename, [self.infile], estimator = len)
+        assert_equal(scheduler.report[0][1], len(self.infile))
+
+    def test_failed_job(self):
+        scheduler = MemoryScheduler(ncores = 1)
+        results = scheduler.run(int, [self.infile])
+        assert_equal(results, [None])
+
+    def test_lost_result(self):
+        # result can not be pickled, worker exits 0 without reporting
+        scheduler = MemoryScheduler(ncores = 1)
+        scheduler.grace = 0
+        results = scheduler.run(lambda infile: lambda: infile,
+                                [self.infile])
+        assert_equal(results, [None])
+        assert_equal(scheduler.report[0][2], None)
+
+
 class TestCMTransform(TestCase):
     infile = join(join(data_path, 'B00-100'), 'test.nii')
     infile2 = join(join(data_path, 'B00-100'), 'test2.nii')